@@ -29,6 +29,37 @@ from .miner import BaseMiner
 from .config import config, check_config
 
 
+# Defined once at import time, each instance dispatches to the miner it was built for.
+class Synapse(bt.TextPromptingSynapse):
+    def __init__(self, miner: "BasePromptingMiner"):
+        super(Synapse, self).__init__(axon=miner.axon)
+        self.miner = miner
+
+    # Build priority function.
+    def priority(self, forward_call: "bt.TextPromptingForwardCall") -> float:
+        return priority(self.miner, self.miner.priority, forward_call)
+
+    # Build blacklist function.
+    def blacklist(
+        self, forward_call: "bt.TextPromptingForwardCall"
+    ) -> Union[Tuple[bool, str], bool]:
+        return blacklist(self.miner, self.miner.blacklist, forward_call)
+
+    # Build forward function.
+    def forward(self, messages: List[Dict[str, str]], log_data: Dict[str, Union[str, float]] = None) -> str:
+        return forward(self.miner, self.miner.forward, messages, log_data)
+
+    # Build backward function.
+    # TODO(const): accept this.
+    def backward(
+        self,
+        messages: List[Dict[str, str]],
+        response: str,
+        rewards: torch.FloatTensor,
+    ) -> str:
+        pass
+
+
 class BasePromptingMiner(BaseMiner, ABC):
     @classmethod
     def config(cls) -> "bt.Config":
@@ -57,32 +88,5 @@ class BasePromptingMiner(BaseMiner, ABC):
     def __init__(self, *args, **kwargs):
         super(BasePromptingMiner, self).__init__(*args, **kwargs)
 
-        # Define synapse.
-        class Synapse(bt.TextPromptingSynapse):
-
-            # Build priority function.
-            def priority(_, forward_call: "bt.TextPromptingForwardCall") -> float:
-                return priority(self, self.priority, forward_call)
-
-            # Build blacklist function.
-            def blacklist(
-                _, forward_call: "bt.TextPromptingForwardCall"
-            ) -> Union[Tuple[bool, str], bool]:
-                return blacklist(self, self.blacklist, forward_call)
-
-            # Build forward function.
-            def forward(_, messages: List[Dict[str, str]], log_data: Dict[str, Union[str, float]] = None) -> str:
-                return forward(self, self.forward, messages, log_data)
-
-            # Build backward function.
-            # TODO(const): accept this.
-            def backward(
-                self,
-                messages: List[Dict[str, str]],
-                response: str,
-                rewards: torch.FloatTensor,
-            ) -> str:
-                pass
-
         # Instantiate synapse.
-        self.synapse = Synapse(axon=self.axon)
+        self.synapse = Synapse(self)
@@ -15,13 +15,16 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+import glob
 import time
 import torch
 import argparse
+import functools
+import threading
 import openminers
-from typing import List, Dict
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline, AutoConfig
-from transformers.deepspeed import HfDeepSpeedConfig
+from typing import List, Dict, Tuple
+from transformers import AutoTokenizer, AutoModelForCausalLM, AutoConfig, BitsAndBytesConfig
+from huggingface_hub import snapshot_download
 import deepspeed
 import bittensor
 import os
@@ -31,13 +34,24 @@ world_size = int(os.getenv('WORLD_SIZE', '1'))
 
 class BloomChatMiner( openminers.BasePromptingMiner ):
 
+    # BLOOMChat only knows two speakers, so system prompts are sent as the human.
+    role_prefixes = {
+        'system': '<human>:',
+        'user': '<human>:',
+        'assistant': '<bot>:',
+    }
+
+    # BLOOM was trained on 2048 token sequences, longer prompts skip the pinned staging buffer.
+    max_pinned_tokens = 2048
+
     @classmethod
     def add_args( cls, parser: argparse.ArgumentParser ):
         parser.add_argument('--deployment_framework',  type=str, choices=['accelerate', 'deepspeed'], default="accelerate", help='Inference framework to use for multi-gpu inference')
         parser.add_argument( '--use_8_bit', action='store_true', default=False, help='Whether to use int8 quantization or not.' )
-        parser.add_argument( '--use_4_bit',  action='store_true', default=False, help='Whether to use int4 quantization or not' )
+        parser.add_argument( '--use_4_bit',  action='store_true', default=False, help='Whether to use int4 (NF4) quantization or not' )
         parser.add_argument('--bloom.model_name', type=str, default="sambanovasystems/BLOOMChat-176B-v1", help='Name/path of model to load' )
         parser.add_argument('--bloom.max_new_tokens', type=int, default=100, help='Number of new tokens to generate' )
+        parser.add_argument('--bloom.history_cache_size', type=int, default=1024, help='Number of tokenized chat messages to keep cached across requests.' )
 
     @classmethod
     def config( cls ) -> "bittensor.Config":
@@ -59,124 +73,159 @@ class BloomChatMiner( openminers.BasePromptingMiner ):
 
             self.tokenizer = AutoTokenizer.from_pretrained(self.config.bloom.model_name)
 
-            config = AutoConfig.from_pretrained(self.config.bloom.model_name, trust_remote_code=True)
-
-            model_hidden_size = config.hidden_size
-
-            # batch size has to be divisible by world_size, but can be bigger than world_size
-            train_batch_size = 1 * world_size
-
-            # ds_config notes
-            #
-            # - enable bf16 if you use Ampere or higher GPU - this will run in mixed precision and will be
-            # faster.
-            #
-            # - for older GPUs you can enable fp16, but it'll only work for non-bf16 pretrained models - e.g.
-            # all official t5 models are bf16-pretrained
-            #
-            # - set offload_param.device to "none" or completely remove the `offload_param` section if you don't
-            # - want CPU offload
-            #
-            # - if using `offload_param` you can manually finetune stage3_param_persistence_threshold to control
-            # - which params should remain on gpus - the larger the value the smaller the offload size
-            #
-            # For indepth info on Deepspeed config see
-            # https://huggingface.co/docs/transformers/master/main_classes/deepspeed
-            ds_config = {
-                "fp16": {
-                    "enabled": True,
-                },
-                "bf16": {
-                    "enabled": False,
-                },
-                "zero_optimization": {
-                    "stage": 3,
-                    "offload_param": {
-                        "device": "cpu",
-                        "pin_memory": True
-                    },
-                    "overlap_comm": True,
-                    "contiguous_gradients": True,
-                    "reduce_bucket_size": model_hidden_size * model_hidden_size,
-                    "stage3_prefetch_bucket_size": 0.9 * model_hidden_size * model_hidden_size,
-                    "stage3_param_persistence_threshold": 10 * model_hidden_size
-                },
-                "steps_per_print": 2000,
-                "train_batch_size": train_batch_size,
-                "train_micro_batch_size_per_gpu": 1,
-                "wall_clock_breakdown": False
+            # the model is built on the meta device so no rank materializes the full fp16 weights in host
+            # memory (~350GB for BLOOMChat-176B). init_inference then loads only this rank's tensor parallel
+            # shard straight from the checkpoint files.
+            config = AutoConfig.from_pretrained(self.config.bloom.model_name)
+            with deepspeed.OnDevice(dtype=torch.float16, device="meta"):
+                self.model = AutoModelForCausalLM.from_config(config, torch_dtype=torch.float16)
+            self.model.eval()
+
+            checkpoint_dir = self._checkpoint_dir(self.config.bloom.model_name)
+            checkpoint = {
+                "type": "BLOOM",
+                "checkpoints": sorted(glob.glob(os.path.join(checkpoint_dir, "pytorch_model*.bin"))),
+                "version": 1.0,
             }
 
-            # next line instructs transformers to partition the model directly over multiple gpus using
-            # deepspeed.zero.Init when model's `from_pretrained` method is called.
-            #
-            # **it has to be run before loading the model AutoModelForSeq2SeqLM.from_pretrained(model_name)**
+            # initialise the deepspeed inference engine. This shards the weights across world_size gpus
+            # with tensor parallelism and replaces the transformer blocks with deepspeed's fused kernels.
             #
-            # otherwise the model will first be loaded normally and only partitioned at forward time which is
-            # less efficient and when there is little CPU RAM may fail
-            dschf = HfDeepSpeedConfig(ds_config) # keep this object alive
-
-            # now a model can be loaded.
-            self.model = AutoModelForCausalLM.from_pretrained(self.config.bloom.model_name, trust_remote_code=True)
-
-            # initialise deepspeed ZeRO
-            self.ds_engine = deepspeed.initialize(model=self.model,
-                                            config_params=ds_config,
-                                            model_parameters=None,
-                                            optimizer=None,
-                                            lr_scheduler=None)[0]
-            self.ds_engine.module.eval() 
+            # For indepth info on Deepspeed inference see
+            # https://www.deepspeed.ai/tutorials/inference-tutorial/
+            self.ds_engine = deepspeed.init_inference(
+                self.model,
+                mp_size=world_size,
+                dtype=torch.float16,
+                replace_with_kernel_inject=True,
+                base_dir=checkpoint_dir,
+                checkpoint=checkpoint,
+            )
         else:
+            if self.config.use_8_bit and self.config.use_4_bit:
+                raise ValueError(
+                    "You can't use 8 bit and 4 bit precision at the same time"
+                )
+
             self.tokenizer = AutoTokenizer.from_pretrained(self.config.bloom.model_name)
 
+            # 4 bit weights are stored as NF4 with double quantization, while matmuls run in bf16.
+            quantization_config = None
+            if self.config.use_8_bit or self.config.use_4_bit:
+                quantization_config = BitsAndBytesConfig(
+                    load_in_8bit=self.config.use_8_bit,
+                    load_in_4bit=self.config.use_4_bit,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_compute_dtype=torch.bfloat16,
+                    bnb_4bit_use_double_quant=True,
+                )
+
             self.model = AutoModelForCausalLM.from_pretrained(
                 self.config.bloom.model_name, 
                 device_map="auto", 
-                load_in_8bit=self.config.use_8_bit, 
-                load_in_4bit=self.config.use_4_bit,
+                quantization_config=quantization_config,
             )
+            self.model.eval()
 
-            self.pipe = pipeline( 
-                "text-generation",
-                model=self.model,
-                tokenizer=self.tokenizer,
-                device_map="auto",
-            )
+        self._init_prompt_encoding( self.config.bloom.history_cache_size )
+
+        # Prompts are staged through one reusable pinned host buffer so the host to device copy can be
+        # issued asynchronously instead of allocating and copying from pageable memory on every request.
+        self.pinned_ids = None
+        if torch.cuda.is_available():
+            self.pinned_ids = torch.empty( ( 1, self.max_pinned_tokens ), dtype=torch.long, pin_memory=True )
+            self.pinned_lock = threading.Lock()
+            self.pinned_copy_done = torch.cuda.Event()
 
     @staticmethod
-    def _process_history( history: List[ Dict[str, str] ] ) -> str:
-        processed_history = ''
+    def _checkpoint_dir( model_name: str ) -> str:
+        # Local checkpoints are used as is, hub checkpoints are downloaded once by rank 0 while the other
+        # ranks wait and then resolve the same cached snapshot.
+        if os.path.isdir( model_name ):
+            return model_name
+        if torch.distributed.get_rank() == 0:
+            snapshot_download( model_name, allow_patterns=["*.json", "*.bin"] )
+        torch.distributed.barrier()
+        return snapshot_download( model_name, allow_patterns=["*.json", "*.bin"] )
+
+    def _init_prompt_encoding( self, history_cache_size: int ):
+        # Role prefixes never change, so they are tokenized once here instead of on every request.
+        self.role_ids = {
+            role: self.tokenizer.encode( prefix, add_special_tokens=False )
+            for role, prefix in self.role_prefixes.items()
+        }
+
+        # Follow-up turns resend the whole conversation, so each message is tokenized once and reused
+        # from the cache when it shows up again in a longer history.
+        self._encode_message = functools.lru_cache( maxsize=history_cache_size )( self._encode_message )
+
+    def _encode_message( self, role: str, content: str ) -> Tuple[int, ...]:
+        # Builds the token ids of '<role>: content\n' directly. BLOOM's pre-tokenizer always splits after
+        # the ':' of the prefix, but trailing punctuation or whitespace in the content forms a single piece
+        # with the '\n', so the content and newline have to be encoded together to match the ids of the
+        # full prompt string.
+        return tuple(
+            self.role_ids[ role ]
+            + self.tokenizer.encode( ' ' + content + '\n', add_special_tokens=False )
+        )
+
+    def _process_history( self, history: List[ Dict[str, str] ] ) -> torch.LongTensor:
+        input_ids = []
         for message in history:
-            if message['role'] == 'system':
-                processed_history += '<human>: ' + message['content'] + '\n'
-            if message['role'] == 'assistant':
-                processed_history += '<bot>: ' + message['content'] + '\n'
-            if message['role'] == 'user':
-                processed_history += '<human>: ' + message['content'] + '\n'
-        return processed_history
+            if message['role'] in self.role_ids:
+                input_ids += self._encode_message( message['role'], message['content'] )
+        return torch.tensor( [ input_ids ], dtype=torch.long )
+
+    def _to_device( self, input_ids: torch.LongTensor, device: torch.device ) -> torch.LongTensor:
+        length = input_ids.shape[1]
+        if self.pinned_ids is None or device.type != 'cuda' or length > self.max_pinned_tokens:
+            return input_ids.to( device )
+
+        with self.pinned_lock:
+            # The previous copy out of the buffer has to land before it is overwritten.
+            self.pinned_copy_done.synchronize()
+            self.pinned_ids[:, :length].copy_( input_ids )
+            input_ids = self.pinned_ids[:, :length].to( device, non_blocking=True )
+            self.pinned_copy_done.record( torch.cuda.current_stream( device ) )
+        return input_ids
 
     def forward( self, messages: List[Dict[str, str]]  ) -> str:
-        history = self._process_history(messages)
+        t_generate_start = time.perf_counter()
+        input_ids = self._process_history(messages)
 
         if self.config.deployment_framework == "deepspeed":
-            inputs = self.tokenizer.encode(history, return_tensors="pt").to(device=self.local_rank)
-            with torch.no_grad():
-                outputs = self.ds_engine.module.generate(inputs, max_length= 60)
-            resp = self.tokenizer.decode(outputs[0], skip_special_tokens=True).replace( str( history ), "")
+            input_ids = self._to_device(input_ids, torch.device('cuda', self.local_rank))
+            with torch.inference_mode():
+                outputs = self.ds_engine.module.generate(
+                    input_ids,
+                    max_new_tokens=self.config.bloom.max_new_tokens,
+                    eos_token_id=self.tokenizer.eos_token_id,
+                    pad_token_id=self.tokenizer.eos_token_id,
+                )
         
         else:
-            resp = self.pipe( 
-                history, 
-                max_new_tokens=self.config.bloom.max_new_tokens,
-                do_sample=True,
-                top_k=10,
-                num_return_sequences=1,
-                eos_token_id=self.tokenizer.eos_token_id, 
-            )[0]['generated_text'].split(':')[-1].replace( str( history ), "")
-        
-        # Logging input and generation if debugging is active
-        bittensor.logging.debug( "Message: " + str( messages ) )
-        bittensor.logging.debug( "Generation: " + str( resp ) )
+            input_ids = self._to_device(input_ids, self.model.device)
+            with torch.inference_mode():
+                outputs = self.model.generate(
+                    input_ids=input_ids,
+                    attention_mask=torch.ones_like(input_ids),
+                    max_new_tokens=self.config.bloom.max_new_tokens,
+                    use_cache=True,
+                    do_sample=True,
+                    top_k=10,
+                    eos_token_id=self.tokenizer.eos_token_id,
+                    pad_token_id=self.tokenizer.eos_token_id,
+                )
+
+        # Only decode the newly generated tokens, the prompt is never part of the response.
+        resp = self.tokenizer.decode(outputs[0, input_ids.shape[1]:], skip_special_tokens=True)
+
+        # Logging input and generation if debugging is active. The check skips formatting the whole
+        # message history on every request when debug logging is off.
+        if self.config.logging.debug or self.config.logging.trace:
+            bittensor.logging.debug( "Message: " + str( messages ) )
+            bittensor.logging.debug( "Generation: " + str( resp ) )
+            bittensor.logging.debug( "Generation time: {:.3f}s".format( time.perf_counter() - t_generate_start ) )
         return resp
 
 if __name__ == "__main__":  
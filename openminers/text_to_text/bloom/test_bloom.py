@@ -0,0 +1,93 @@
+# The MIT License (MIT)
+# Copyright © 2023 Yuma Rao
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the “Software”), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of
+# the Software.
+
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO
+# THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import pytest
+
+bloom = pytest.importorskip("openminers.text_to_text.bloom.miner")
+transformers = pytest.importorskip("transformers")
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    try:
+        return transformers.AutoTokenizer.from_pretrained("sambanovasystems/BLOOMChat-176B-v1")
+    except OSError:
+        pytest.skip("BLOOMChat tokenizer is not available")
+
+
+@pytest.fixture
+def miner(tokenizer):
+    # Skip __init__, which loads the 176B model, and only set up what prompt encoding needs.
+    miner = bloom.BloomChatMiner.__new__(bloom.BloomChatMiner)
+    miner.tokenizer = tokenizer
+    miner._init_prompt_encoding(history_cache_size=16)
+    return miner
+
+
+def string_prompt(history):
+    # The prompt string the miner tokenized before it built the history from token ids.
+    prefixes = {"system": "<human>: ", "user": "<human>: ", "assistant": "<bot>: "}
+    return "".join(
+        prefixes[message["role"]] + message["content"] + "\n"
+        for message in history
+        if message["role"] in prefixes
+    )
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "What is the capital of Texas",
+        "What is the capital of Texas?",
+        "Austin.",
+        "Sure! ",
+        "Wait...",
+        "trailing space ",
+        "  padded  ",
+        "line one\nline two!",
+        "",
+    ],
+)
+def test_process_history_matches_string_prompt(miner, content):
+    history = [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": content},
+        {"role": "assistant", "content": content},
+        {"role": "unknown", "content": "skipped"},
+        {"role": "user", "content": "Thanks!"},
+    ]
+    input_ids = miner._process_history(history)
+    assert input_ids.tolist() == [miner.tokenizer.encode(string_prompt(history))]
+
+
+def test_repeated_message_hits_cache(miner):
+    history = [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": "What is the capital of Texas?"},
+    ]
+    first = miner._process_history(history)
+    follow_up = history + [
+        {"role": "assistant", "content": "Austin."},
+        {"role": "user", "content": "And of Ohio?"},
+    ]
+    miner._process_history(follow_up)
+
+    # The follow-up turn only tokenizes its two new messages.
+    cache_info = miner._encode_message.cache_info()
+    assert cache_info.hits == 2
+    assert cache_info.misses == 4
+    assert miner._process_history(history).tolist() == first.tolist()